@@ -1,132 +1,275 @@
 #!/usr/bin/env python3
 # get-domain-ciphers.py
 
-import subprocess
+import asyncio
 import shutil
 import sys
 import xml.etree.ElementTree as ET
 import sqlite3
-from concurrent.futures import ThreadPoolExecutor
-import concurrent
 import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Resolved once so scans don't walk PATH for every host
+SSLSCAN_PATH = shutil.which("sslscan")
+# Maximum number of sslscan processes running at once
+MAX_SCANS = 32
+# Bytes read from the sslscan pipe per parser feed
+SSLSCAN_READ_SIZE = 1 << 16
+
+# Sentinel telling the writer task there are no more results
+WRITER_SENTINEL = None
+# Commit the writer transaction after this many results or seconds
+WRITER_BATCH_SIZE = 50
+WRITER_BATCH_SECONDS = 1.0
+# Attempts at a batch before the writer gives up on a locked database
+WRITER_RETRIES = 3
+
+# Bumped whenever the DDL in setup_database changes
+SCHEMA_VERSION = 2
+
+INSERT_CIPHER_SQL = '''
+    INSERT OR IGNORE INTO ciphers (cipher_id, sslversion, cipher_name, bits, status)
+    VALUES (?, ?, ?, ?, ?)
+'''
+INSERT_DOMAIN_CIPHER_SQL = '''
+    INSERT OR IGNORE INTO domain_ciphers (domain_id, cipher_id)
+    VALUES (?, ?)
+'''
+# Look up or create a domain_names row in one statement (SQLite 3.35+)
+UPSERT_DOMAIN_NAME_SQL = '''
+    INSERT INTO domain_names (name_value) VALUES (?)
+    ON CONFLICT (name_value) DO UPDATE SET name_value = excluded.name_value
+    RETURNING id
+'''
+SQLITE_HAS_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
+
+# cipher_ids already stored, only touched by the writer thread
+_SEEN_CIPHERS = set()
 
+# Connection PRAGMAs: WAL lets readers run alongside the writer and
+# synchronous=NORMAL only fsyncs on checkpoint instead of every commit.
+# subdomain_enumeration.py opens domains.db with the same PRAGMAs
+CONNECTION_PRAGMAS = (
+    "journal_mode=WAL",
+    "synchronous=NORMAL",
+    "temp_store=MEMORY",
+    "mmap_size=268435456",
+    "cache_size=-65536",
+    "busy_timeout=5000",
+)
+
+def configure_connection(conn):
+    """Apply the performance PRAGMAs to a freshly opened connection"""
+    for pragma in CONNECTION_PRAGMAS:
+        conn.execute(f"PRAGMA {pragma}")
+    return conn
+
+def connect_database(**kwargs):
+    """Open a configured connection to domains.db"""
+    return configure_connection(sqlite3.connect('domains.db', **kwargs))
 
 def setup_database():
     """Create the domain_names table if it doesn't exist"""
-    conn = sqlite3.connect('domains.db')
+    conn = connect_database()
     cursor = conn.cursor()
 
-    # Create domain_names table
-    cursor.execute('''
-         CREATE TABLE IF NOT EXISTS ciphers (
-            cipher_id TEXT PRIMARY KEY,
-            sslversion TEXT NOT NULL,
-            cipher_name TEXT NOT NULL,
-            bits TEXT NOT NULL,
-            status TEXT NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        );
-    ''')
+    # Only run the DDL when the schema is older than this script
+    cursor.execute("PRAGMA user_version")
+    if cursor.fetchone()[0] < SCHEMA_VERSION:
+        cursor.execute("BEGIN")
 
-    # Create table that maps domain names to ciphers
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS domain_ciphers (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            domain_id INTEGER,
-            cipher_id TEXT,
-            FOREIGN KEY (domain_id) REFERENCES domain_names (id) ON DELETE CASCADE,
-            FOREIGN KEY (cipher_id) REFERENCES ciphers (cipher_id) ON DELETE CASCADE
-        );
-    ''')
+        # Create domain_names table
+        cursor.execute('''
+             CREATE TABLE IF NOT EXISTS ciphers (
+                cipher_id TEXT PRIMARY KEY,
+                sslversion TEXT NOT NULL,
+                cipher_name TEXT NOT NULL,
+                bits TEXT NOT NULL,
+                status TEXT NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            );
+        ''')
+
+        # Older databases keyed domain_ciphers on a surrogate id, move them aside to rebuild
+        cursor.execute("PRAGMA table_info(domain_ciphers)")
+        migrate_domain_ciphers = any(column[1] == 'id' for column in cursor.fetchall())
+        if migrate_domain_ciphers:
+            cursor.execute('DROP INDEX IF EXISTS idx_domain_ciphers_domain_id')
+            cursor.execute('ALTER TABLE domain_ciphers RENAME TO domain_ciphers_old')
+
+        # Create table that maps domain names to ciphers
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS domain_ciphers (
+                domain_id INTEGER NOT NULL,
+                cipher_id TEXT NOT NULL,
+                PRIMARY KEY (domain_id, cipher_id),
+                FOREIGN KEY (domain_id) REFERENCES domain_names (id) ON DELETE CASCADE,
+                FOREIGN KEY (cipher_id) REFERENCES ciphers (cipher_id) ON DELETE CASCADE
+            ) WITHOUT ROWID;
+        ''')
+
+        if migrate_domain_ciphers:
+            cursor.execute('''
+                INSERT INTO domain_ciphers (domain_id, cipher_id)
+                SELECT DISTINCT domain_id, cipher_id FROM domain_ciphers_old
+                WHERE domain_id IS NOT NULL AND cipher_id IS NOT NULL
+            ''')
+            cursor.execute('DROP TABLE domain_ciphers_old')
+
+        cursor.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
 
     conn.commit()
     return conn
 
-def run_sslscan_xml(host, port=443):
-    if not shutil.which("sslscan"):
-        print("Error: sslscan is not installed or not in PATH.")
-        sys.exit(1)
+async def wait_for_sslscan(proc):
+    """Wait for sslscan to exit, raising its stderr if it failed"""
+    stderr = await proc.stderr.read()
+    if await proc.wait() != 0:
+        raise RuntimeError(f"sslscan exited with {proc.returncode}: {stderr.decode(errors='replace').strip()}")
 
-    command = ["sslscan", "--xml=-", "--show-cipher-ids", f"{host}:{port}"]
+async def scan_accepted_ciphers(host, port=443):
+    """Run sslscan for host:port, yielding accepted ciphers as its XML streams in"""
+    command = [SSLSCAN_PATH, "--xml=-", "--show-cipher-ids", f"{host}:{port}"]
 
+    proc = await asyncio.create_subprocess_exec(
+        *command, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+    )
+    parser = ET.XMLPullParser(events=("end",))
+    parse_error = None
     try:
-        result = subprocess.run(command, capture_output=True, text=True, check=True)
-        return result.stdout
-    except subprocess.CalledProcessError as e:
-        print("Error running sslscan:")
-        print(e.stderr)
-        sys.exit(1)
+        try:
+            while chunk := await proc.stdout.read(SSLSCAN_READ_SIZE):
+                parser.feed(chunk)
+                for _, elem in parser.read_events():
+                    if elem.tag != "cipher":
+                        continue
+                    status = elem.attrib.get("status")
+                    if status in {"accepted", "preferred"}:
+                        yield {
+                            "sslversion": elem.attrib.get("sslversion", ""),
+                            "cipher_name": elem.attrib.get("cipher", ""),
+                            "bits": elem.attrib.get("bits", ""),
+                            "cipher_id": elem.attrib.get("id", ""),
+                            "status": status
+                        }
+                    # Parsed ciphers are no longer needed, drop them to keep memory flat
+                    elem.clear()
+            parser.close()
+        except ET.ParseError as e:
+            # A failed sslscan usually prints no XML, report its own diagnostic first
+            parse_error = e
+            await proc.stdout.read()
+        await wait_for_sslscan(proc)
+    finally:
+        # Never leave sslscan running, whichever way the scan ended
+        if proc.returncode is None:
+            proc.kill()
+            await proc.wait()
 
-def extract_accepted_ciphers(xml_data):
-    ciphers = []
-    root = ET.fromstring(xml_data)
-
-    for cipher in root.findall(".//cipher"):
-        status = cipher.attrib.get("status")
-        if status in {"accepted", "preferred"}:
-            sslversion = cipher.attrib.get("sslversion", "")
-            cipher_name = cipher.attrib.get("cipher", "")
-            cipher_id = cipher.attrib.get("id", "")
-            bits = cipher.attrib.get("bits", "")
-            ciphers.append({
-                "sslversion": sslversion,
-                "cipher_name": cipher_name,
-                "bits": bits,
-                "cipher_id": cipher_id,
-                "status": status
-            })
-    return ciphers
+    if parse_error:
+        raise parse_error
 
 def insert_ciphers_to_db(ciphers, conn):
+    # Most hosts share the same ciphers, only send ones not stored yet
+    new_ciphers = [c for c in ciphers if c['cipher_id'] not in _SEEN_CIPHERS]
+    if not new_ciphers:
+        return
     cursor = conn.cursor()
-    for cipher in ciphers:
-        cursor.execute('''
-            INSERT OR IGNORE INTO ciphers (cipher_id, sslversion, cipher_name, bits, status)
-            VALUES (?, ?, ?, ?, ?)
-        ''', (cipher['cipher_id'], cipher['sslversion'], cipher['cipher_name'], cipher['bits'], cipher['status']))
-    conn.commit()
+    cursor.executemany(INSERT_CIPHER_SQL, [(c['cipher_id'], c['sslversion'], c['cipher_name'], c['bits'], c['status']) for c in new_ciphers])
+    _SEEN_CIPHERS.update(c['cipher_id'] for c in new_ciphers)
 
 def map_domain_to_ciphers(host, ciphers, conn):
     cursor = conn.cursor()
-    cursor.execute('SELECT id FROM domain_names WHERE name_value = ?', (host,))
-    domain_id = cursor.fetchone()
-
-    if not domain_id:
-        cursor.execute('INSERT INTO domain_names (name_value) VALUES (?)', (host,))
-        domain_id = cursor.lastrowid
+    if SQLITE_HAS_RETURNING:
+        cursor.execute(UPSERT_DOMAIN_NAME_SQL, (host,))
     else:
-        domain_id = domain_id[0]
+        cursor.execute('INSERT OR IGNORE INTO domain_names (name_value) VALUES (?)', (host,))
+        cursor.execute('SELECT id FROM domain_names WHERE name_value = ?', (host,))
+    domain_id = cursor.fetchone()[0]
 
-    for cipher in ciphers:
-        cursor.execute('''
-            INSERT OR IGNORE INTO domain_ciphers (domain_id, cipher_id)
-            VALUES (?, ?)
-        ''', (domain_id, cipher['cipher_id']))
-    conn.commit()
+    cursor.executemany(INSERT_DOMAIN_CIPHER_SQL, [(domain_id, c['cipher_id']) for c in ciphers])
 
-def process_domain(conn, host, port=443):
+async def process_domain(processed_hosts, host, port=443):
     # skip if domain_ciphers already has entries for this host
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT count(1) FROM domain_ciphers dc
-        LEFT JOIN domain_names dn ON dc.domain_id = dn.id
-        LEFT JOIN tlds t ON dn.tld_id = t.id
-        WHERE dn.name_value = ? AND t.skip_existing = 1
-    ''', (host,))
-    if cursor.fetchone()[0] > 0:
+    if host in processed_hosts:
         print(f"Domain {host} already processed, skipping...")
         return []
     print(f"Processing {host}:{port} for SSL ciphers...")
 
-    xml_output = run_sslscan_xml(host, port)
-    ciphers = extract_accepted_ciphers(xml_output)
+    ciphers = [cipher async for cipher in scan_accepted_ciphers(host, port)]
     if not ciphers:
         print(f"No accepted ciphers found for {host}:{port}.")
         return []
-    insert_ciphers_to_db(ciphers, conn)
-    map_domain_to_ciphers(host, ciphers, conn)
+    return ciphers
+
+def write_batch(conn, batch):
+    """Store a batch of (host, ciphers) results in one transaction, retrying if the database is locked"""
+    for attempt in range(1, WRITER_RETRIES + 1):
+        try:
+            # Take the write lock up front so the batch never upgrades mid-transaction
+            conn.execute("BEGIN IMMEDIATE")
+            for host, ciphers in batch:
+                try:
+                    insert_ciphers_to_db(ciphers, conn)
+                    map_domain_to_ciphers(host, ciphers, conn)
+                except sqlite3.Error as e:
+                    print(f"Error storing ciphers for {host}: {e}")
+            conn.execute("COMMIT")
+            return
+        except sqlite3.OperationalError as e:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            # Ciphers inserted by the rolled back batch are gone again
+            _SEEN_CIPHERS.clear()
+            _SEEN_CIPHERS.update(row[0] for row in conn.execute("SELECT cipher_id FROM ciphers"))
+            if attempt == WRITER_RETRIES:
+                raise
+            print(f"Error writing {len(batch)} results, retrying ({attempt}/{WRITER_RETRIES}): {e}")
+
+def open_writer_connection():
+    """Open the writer connection and load the cipher_ids it has already stored"""
+    # Transactions are driven manually, one per batch
+    conn = connect_database(isolation_level=None)
+    _SEEN_CIPHERS.update(row[0] for row in conn.execute("SELECT cipher_id FROM ciphers"))
+    return conn
+
+async def writer_task(results):
+    """Write (host, ciphers) results from the queue through a single connection"""
+    loop = asyncio.get_running_loop()
+    # sqlite calls block (up to busy_timeout), keep them on one thread off the event loop
+    with ThreadPoolExecutor(max_workers=1) as db_thread:
+        conn = await loop.run_in_executor(db_thread, open_writer_connection)
+        batch = []
+        deadline = None
+        try:
+            while True:
+                # Results are buffered in memory so no write lock is held while waiting on scans
+                timeout = max(0.0, deadline - time.monotonic()) if batch else None
+                try:
+                    result = await asyncio.wait_for(results.get(), timeout)
+                except asyncio.TimeoutError:
+                    await loop.run_in_executor(db_thread, write_batch, conn, batch)
+                    batch = []
+                    continue
+                if result is WRITER_SENTINEL:
+                    break
+
+                if not batch:
+                    deadline = time.monotonic() + WRITER_BATCH_SECONDS
+                batch.append(result)
+                if len(batch) >= WRITER_BATCH_SIZE:
+                    await loop.run_in_executor(db_thread, write_batch, conn, batch)
+                    batch = []
+            if batch:
+                await loop.run_in_executor(db_thread, write_batch, conn, batch)
+        finally:
+            db_thread.submit(conn.close)
+
+async def process_domains():
+    if not SSLSCAN_PATH:
+        print("Error: sslscan is not installed or not in PATH.")
+        sys.exit(1)
 
-def process_domains():
     conn = setup_database()
     cursor = conn.cursor()
 
@@ -137,35 +280,60 @@ def process_domains():
         return
     print(f"Processing {len(domains)} domains for SSL ciphers...")
 
-    # Function that wraps process_domain to use a separate connection for each thread
-    def process_domain_wrapper(host, port=443):
-        try:
-            local_conn = sqlite3.connect('domains.db')
-            result = process_domain(local_conn, host, port)
-            local_conn.close()
-            return host, True
-        except Exception as e:
-            print(f"Error processing {host}: {e}")
-            return host, False
-
-    # Set max_workers based on your system capabilities
-    max_workers = min(32, len(domains))
-    print(f"Using {max_workers} workers for parallel processing...")
+    # Hosts with stored ciphers under a skip_existing TLD, fetched in one pass
+    cursor.execute('''
+        SELECT dn.name_value FROM domain_names dn
+        JOIN tlds t ON dn.tld_id = t.id
+        JOIN domain_ciphers dc ON dc.domain_id = dn.id
+        WHERE t.skip_existing = 1
+        GROUP BY dn.id
+    ''')
+    processed_hosts = frozenset(row[0] for row in cursor.fetchall())
 
-    start_time = time.time()
-    with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        # Submit all tasks
-        futures = [executor.submit(process_domain_wrapper, host) for host in domains]
+    # All writes go through a single writer task, scans never touch the database
+    results = asyncio.Queue()
+    writer = asyncio.create_task(writer_task(results))
+
+    # Bound the number of concurrent sslscan processes
+    max_scans = min(MAX_SCANS, len(domains))
+    semaphore = asyncio.Semaphore(max_scans)
+    print(f"Using {max_scans} concurrent scans for parallel processing...")
+
+    completed = 0
 
-        # Process results as they complete
-        completed = 0
-        for future in concurrent.futures.as_completed(futures):
-            completed += 1
-            host, success = future.result()
-            print(f"Processed {host} - {'Success' if success else 'Failed'} ({completed}/{len(domains)})")
+    # Function that wraps process_domain to limit concurrency and report progress
+    async def process_domain_wrapper(host, port=443):
+        nonlocal completed
+        async with semaphore:
+            try:
+                ciphers = await process_domain(processed_hosts, host, port)
+                if ciphers:
+                    results.put_nowait((host, ciphers))
+                success = True
+            except Exception as e:
+                print(f"Error processing {host}: {e}")
+                success = False
+        completed += 1
+        print(f"Processed {host} - {'Success' if success else 'Failed'} ({completed}/{len(domains)})")
+
+    start_time = time.time()
+    scans = asyncio.gather(*(process_domain_wrapper(host) for host in domains))
+    try:
+        # The writer only finishes early if it failed, stop scanning when it does
+        await asyncio.wait({scans, writer}, return_when=asyncio.FIRST_COMPLETED)
+        if writer.done():
+            scans.cancel()
+            await asyncio.gather(scans, return_exceptions=True)
+            writer.result()
+        await scans
+    finally:
+        # Flush outstanding results even if the run was interrupted
+        if not writer.done():
+            results.put_nowait(WRITER_SENTINEL)
+            await writer
 
     print(f"All domains processed in {time.time() - start_time:.2f} seconds")
     conn.close()
 
 if __name__ == "__main__":
-    process_domains()
+    asyncio.run(process_domains())
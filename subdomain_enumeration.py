@@ -1,15 +1,69 @@
 #!/usr/bin/env python3
 # subdomain_enumeration.py
 
+import argparse
+import functools
 import sqlite3
 import requests
 import json
-import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from itertools import islice
+from requests.adapters import HTTPAdapter
+from requests_cache import CachedSession
 from urllib.parse import quote
+from urllib3.util.retry import Retry
+
+try:
+    # orjson parses the crt.sh payload straight from bytes, much faster than json
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+# Number of rows sent to SQLite per executemany call
+INSERT_CHUNK_SIZE = 500
+# Number of concurrent DNS lookups, the HTTP pool is sized to match
+DNS_WORKERS = 64
+# Number of TLDs fetched from crt.sh at once
+TLD_WORKERS = 8
+
+INSERT_DOMAIN_NAME_SQL = "INSERT OR IGNORE INTO domain_names (tld_id, name_value, resolver_answer) VALUES (?, ?, ?)"
+
+# Shared session so DNS lookups reuse pooled TLS connections
+SESSION = requests.Session()
+SESSION.mount('https://', HTTPAdapter(pool_connections=DNS_WORKERS, pool_maxsize=DNS_WORKERS, max_retries=3))
+
+# crt.sh responses are large and change slowly, keep them in a local cache
+CRTSH_SESSION = CachedSession('.crtsh_cache.sqlite', expire_after=3600, cache_control=True)
+# Be respectful to the API - only back off when crt.sh says it is overloaded,
+# connection errors and timeouts are not retried
+CRTSH_SESSION.mount('https://', HTTPAdapter(max_retries=Retry(
+    total=None, connect=0, read=0, other=0, status=5,
+    backoff_factor=2, status_forcelist=(429, 503), respect_retry_after_header=True
+)))
+
+# Keep in sync with CONNECTION_PRAGMAS in get_domain_ciphers.py
+CONNECTION_PRAGMAS = (
+    "journal_mode=WAL",
+    "synchronous=NORMAL",
+    "temp_store=MEMORY",
+    "mmap_size=268435456",
+    "cache_size=-65536",
+    "busy_timeout=5000",
+)
+
+def configure_connection(conn):
+    """Apply the performance PRAGMAs to a freshly opened connection"""
+    for pragma in CONNECTION_PRAGMAS:
+        conn.execute(f"PRAGMA {pragma}")
+    return conn
+
+def connect_database(**kwargs):
+    """Open a configured connection to domains.db"""
+    return configure_connection(sqlite3.connect('domains.db', **kwargs))
 
 def setup_database():
     """Create the domain_names table if it doesn't exist"""
-    conn = sqlite3.connect('domains.db')
+    conn = connect_database()
     cursor = conn.cursor()
 
     # Create domain_names table
@@ -44,27 +98,25 @@ def setup_database():
         );
     ''')
 
+    # name_value lookups use the UNIQUE index, this one covers per-TLD queries
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_domain_names_tld_id_name_value ON domain_names (tld_id, name_value)')
+
     conn.commit()
     return conn
 
-def fetch_domains_from_crtsh(tld):
+def fetch_domains_from_crtsh(tld, use_cache=True):
     """Fetch certificate data from crt.sh for a given TLD"""
     try:
         url = f"https://crt.sh/json?q={quote(tld)}"
-        response = requests.get(url, timeout=30)
+        # force_refresh skips the cached copy but still stores the new response
+        response = CRTSH_SESSION.get(url, timeout=30, force_refresh=not use_cache)
         response.raise_for_status()
 
-        data = response.json()
-        domains = set()
+        data = json_loads(response.content)
 
-        for cert in data:
-            if 'name_value' in cert:
-                # Split multiple domains that might be in a single name_value
-                name_values = cert['name_value'].split('\n')
-                for domain in name_values:
-                    domain = domain.strip()
-                    if domain:
-                        domains.add(domain)
+        # Split multiple domains that might be in a single name_value, in one pass
+        blob = '\n'.join(cert['name_value'] for cert in data if 'name_value' in cert)
+        domains = {domain for domain in map(str.strip, blob.split('\n')) if domain}
 
         return list(domains)
 
@@ -75,24 +127,61 @@ def fetch_domains_from_crtsh(tld):
         print(f"Error parsing JSON for {tld}: {e}")
         return []
 
+@functools.lru_cache(maxsize=None)
+def query_dns(domain):
+    """Query Google DNS for a domain, memoized for the lifetime of the run"""
+    # Errors are raised rather than returned so failed lookups are not cached
+    response = SESSION.get(f"https://dns.google/resolve?name={domain}", timeout=10)
+    response.raise_for_status()
+    data = response.json()
+    if 'Answer' in data:
+        return tuple(answer['data'] for answer in data['Answer'])
+    else:
+        return ()
+
 def resolve_domain(domain):
     """Resolve a domain to its IP address"""
     try:
-        response = requests.get(f"https://dns.google/resolve?name={domain}", timeout=10)
-        response.raise_for_status()
-        data = response.json()
-        if 'Answer' in data:
-            return [answer['data'] for answer in data['Answer']]
-        else:
-            return []
+        return query_dns(domain)
     except requests.exceptions.RequestException as e:
         print(f"Error resolving {domain}: {e}")
-        return []
+        return ()
+
+def normalize_domain(domain):
+    """Replace a leading wildcard so the name can be stored and resolved"""
+    return "WILDCARD" + domain[1:] if domain.startswith('*') else domain
+
+def insert_domain_names(cursor, domain_data):
+    """Insert domain rows in chunks of INSERT_CHUNK_SIZE"""
+    rows = iter(domain_data)
+    while chunk := list(islice(rows, INSERT_CHUNK_SIZE)):
+        cursor.executemany(INSERT_DOMAIN_NAME_SQL, chunk)
+
+def resolve_domains(executor, names):
+    """Resolve names concurrently, returning the JSON encoded answers in order"""
+    return [json.dumps(answers) for answers in executor.map(resolve_domain, names)]
+
+def collect_tld_domains(executor, tld_id, tld_name, tld_known_subdomain, use_cache=True):
+    """Fetch and resolve the domains of a TLD, returning its domain_names rows"""
+    known_names = [
+        known_subdomain.strip() + '.' + tld_name
+        for known_subdomain in tld_known_subdomain.split(',')
+        if known_subdomain.strip()
+    ]
+
+    # Fetch domains from crt.sh
+    domains = fetch_domains_from_crtsh(tld_name, use_cache)
+    # Known subdomains often show up in crt.sh too, resolve and insert each name once
+    names = list(dict.fromkeys(known_names + [normalize_domain(domain) for domain in domains]))
+
+    domain_data = [(tld_id, name, answer) for name, answer in zip(names, resolve_domains(executor, names))]
+    return domain_data, len(domains)
 
-def process_tlds():
+def process_tlds(use_cache=True):
     """Main function to process TLDs and store domain names"""
     conn = setup_database()
     cursor = conn.cursor()
+    executor = ThreadPoolExecutor(max_workers=DNS_WORKERS)
 
     try:
         # Fetch all TLDs from the tlds table
@@ -101,6 +190,7 @@ def process_tlds():
 
         print(f"Found {len(tlds)} TLDs to process")
 
+        pending_tlds = []
         for tld_id, tld_name, tld_known_subdomain in tlds:
             print(f"Processing TLD: {tld_name}")
 
@@ -115,36 +205,36 @@ def process_tlds():
                 print(f"  Skipping {tld_name} - already has {existing_count} domains")
                 continue
 
-            for known_subdomain in tld_known_subdomain.split(','):
-                known_subdomain = known_subdomain.strip()
-                if known_subdomain:
-                    cursor.execute(
-                        "INSERT OR IGNORE INTO domain_names (tld_id, name_value, resolver_answer) VALUES (?, ?, ?)",
-                        (tld_id, known_subdomain + '.' + tld_name, json.dumps(resolve_domain(known_subdomain + '.' + tld_name)))
-                    )
-            conn.commit()
-
-            # Fetch domains from crt.sh
-            domains = fetch_domains_from_crtsh(tld_name)
-
-            if domains:
-                domain_data = [(tld_id, "WILDCARD" + domain[1:] if domain.startswith('*') else domain, json.dumps(resolve_domain("WILDCARD" + domain[1:] if domain.startswith('*') else domain))) for domain in domains]
-                cursor.executemany(
-                    "INSERT OR IGNORE INTO domain_names (tld_id, name_value, resolver_answer) VALUES (?, ?, ?)",
-                    domain_data
-                )
+            pending_tlds.append((tld_id, tld_name, tld_known_subdomain))
+
+        with ThreadPoolExecutor(max_workers=TLD_WORKERS) as tld_executor:
+            futures = {
+                tld_executor.submit(collect_tld_domains, executor, tld_id, tld_name, tld_known_subdomain, use_cache): tld_name
+                for tld_id, tld_name, tld_known_subdomain in pending_tlds
+            }
+
+            # Workers only fetch and resolve, this thread is the single writer
+            for future in as_completed(futures):
+                tld_name = futures[future]
+                domain_data, domain_count = future.result()
+
+                cursor.execute("BEGIN IMMEDIATE")
+                insert_domain_names(cursor, domain_data)
                 conn.commit()
-                print(f"  Added {len(domains)} domains for {tld_name}")
-            else:
-                print(f"  No domains found for {tld_name}")
 
-            # Be respectful to the API - add a small delay
-            time.sleep(2)
+                if domain_count:
+                    print(f"  Added {domain_count} domains for {tld_name}")
+                else:
+                    print(f"  No domains found for {tld_name}")
 
     except Exception as e:
         print(f"Error processing TLDs: {e}")
     finally:
+        executor.shutdown()
         conn.close()
 
 if __name__ == "__main__":
-    process_tlds()
+    parser = argparse.ArgumentParser(description="Enumerate subdomains of the configured TLDs from crt.sh")
+    parser.add_argument('--no-cache', action='store_true', help="bypass the local crt.sh response cache")
+    args = parser.parse_args()
+    process_tlds(use_cache=not args.no_cache)